@@ -2,16 +2,21 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import uuid
 import os
+import json
+import hashlib
+import threading
+import time
 import pymysql
 from pymysql.cursors import DictCursor
+from collections import OrderedDict
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import send_from_directory
 
 # 将上一级目录作为静态文件根目录，直接提供 user.html 等前端文件
 app = Flask(__name__, static_folder="..", static_url_path="")
 # 允许从本地文件打开的页面（origin 为 null）和任意来源访问 /api/*
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+CORS(app, resources={r"/api/*": {"origins": "*"}}, expose_headers=["Idempotent-Replayed"])
 
 ############################################
 # 配置 & 数据库连接
@@ -24,6 +29,39 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "9860")
 DB_NAME = os.getenv("DB_NAME", "green")
 DB_CREATE_DB = os.getenv("DB_CREATE_DB", "0") == "1"
 
+
+def _parse_replicas(value: str):
+    # 形如 "10.0.0.2:3306,10.0.0.3"，省略端口时沿用 DB_PORT；账号与库名与主库一致
+    replicas = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.partition(":")
+        replicas.append((host, int(port) if port else DB_PORT))
+    return replicas
+
+
+# 只读副本：GET 类查询按轮询分摊到各副本，副本不可用时回退主库
+DB_REPLICAS = _parse_replicas(os.getenv("DB_REPLICAS", ""))
+# 副本连接失败后暂停使用的秒数
+DB_REPLICA_RETRY = int(os.getenv("DB_REPLICA_RETRY", "30"))
+# 副本连接/读取超时（秒），超时即视为副本故障并回退主库
+DB_REPLICA_CONNECT_TIMEOUT = int(os.getenv("DB_REPLICA_CONNECT_TIMEOUT", "2"))
+DB_REPLICA_READ_TIMEOUT = int(os.getenv("DB_REPLICA_READ_TIMEOUT", "5"))
+# 写入后该窗口内同一用户的读请求仍走主库，避免因复制延迟看到旧的积分
+DB_STICKY_SECONDS = float(os.getenv("DB_STICKY_SECONDS", "5"))
+
+replica_lock = threading.Lock()
+replica_rr = 0
+# (host, port) -> 恢复使用的时间戳
+replica_down_until = {}
+# 写入方标识 -> 最近一次写入提交的时间戳
+last_write_at = {}
+# 每记录 N 次写入清扫一次 last_write_at 中已过窗口期的条目
+DB_STICKY_SWEEP_EVERY = 1000
+write_marks = 0
+
 # token -> uid 映射（内存会话管理）
 tokens = {}
 # 商户与管理员会话
@@ -37,17 +75,33 @@ MODE_EN_TO_CN = {"bike": "骑行", "walk": "步行", "bus": "公交出行", "met
 ADMIN_USER = os.getenv("ADMIN_USER", "admin")
 ADMIN_PASS = os.getenv("ADMIN_PASS", "123456")
 
+# 幂等键：客户端在 Idempotency-Key 请求头中携带，重试时直接返回首次的响应
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_KEY_MAX_LEN = 64
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# 每记录 N 个幂等键清理一次过期记录，每次最多删除 IDEMPOTENCY_PURGE_BATCH 行
+IDEMPOTENCY_PURGE_EVERY = int(os.getenv("IDEMPOTENCY_PURGE_EVERY", "100"))
+IDEMPOTENCY_PURGE_BATCH = int(os.getenv("IDEMPOTENCY_PURGE_BATCH", "1000"))
+
+# (uid, endpoint, key) -> (写入时间戳, 请求指纹, 响应体)，按 LRU 淘汰，超过 TTL 视为失效
+idem_cache = OrderedDict()
+idem_cache_lock = threading.Lock()
+idem_saved = 0
+
 
-def _connect(database: str | None = None):
-    # 当 database 为空时，不指定默认库，用于创建数据库
+def _connect(database: str | None = None, host: str | None = None, port: int | None = None, **timeouts):
+    # 当 database 为空时，不指定默认库，用于创建数据库；host/port 为空时连接主库
+    # timeouts 透传 connect_timeout/read_timeout 等超时参数
     kwargs = dict(
-        host=DB_HOST,
-        port=DB_PORT,
+        host=host or DB_HOST,
+        port=port or DB_PORT,
         user=DB_USER,
         password=DB_PASSWORD,
         charset="utf8mb4",
         cursorclass=DictCursor,
         autocommit=False,
+        **timeouts,
     )
     if database is not None:
         kwargs["database"] = database
@@ -56,18 +110,109 @@ def _connect(database: str | None = None):
     return pymysql.connect(**kwargs)
 
 
+def _replica_candidates():
+    # 轮询起点后移一位，跳过仍处于暂停期的副本
+    global replica_rr
+    with replica_lock:
+        start = replica_rr % len(DB_REPLICAS)
+        replica_rr += 1
+        now = time.time()
+        ordered = DB_REPLICAS[start:] + DB_REPLICAS[:start]
+        return [r for r in ordered if replica_down_until.get(r, 0) <= now]
+
+
+def _mark_replica_down(replica, error):
+    host, port = replica
+    with replica_lock:
+        replica_down_until[replica] = time.time() + DB_REPLICA_RETRY
+    print(f"[WARN] replica {host}:{port} unavailable, skipped for {DB_REPLICA_RETRY}s: {error}")
+
+
+def _connect_replica(database: str):
+    for host, port in _replica_candidates():
+        try:
+            conn = _connect(
+                database,
+                host=host,
+                port=port,
+                connect_timeout=DB_REPLICA_CONNECT_TIMEOUT,
+                read_timeout=DB_REPLICA_READ_TIMEOUT,
+            )
+        except pymysql.err.OperationalError as e:
+            _mark_replica_down((host, port), e)
+            continue
+        # 记录所连副本，查询失败时据此暂停该副本
+        conn.replica = (host, port)
+        return conn
+    return _connect(database)
+
+
+def _recently_wrote(sticky_key) -> bool:
+    if sticky_key is None:
+        return False
+    with replica_lock:
+        wrote_at = last_write_at.get(sticky_key)
+        if wrote_at is None:
+            return False
+        if time.time() - wrote_at > DB_STICKY_SECONDS:
+            last_write_at.pop(sticky_key, None)
+            return False
+        return True
+
+
+def _mark_write(sticky_key):
+    global write_marks
+    now = time.time()
+    with replica_lock:
+        last_write_at[sticky_key] = now
+        write_marks += 1
+        if write_marks % DB_STICKY_SWEEP_EVERY == 0:
+            expired = [k for k, t in last_write_at.items() if now - t > DB_STICKY_SECONDS]
+            for k in expired:
+                del last_write_at[k]
+
+
 @contextmanager
-def db_conn(database: str | None = None):
+def db_conn(database: str | None = None, readonly: bool = False, sticky_key=None):
     # 默认连接到目标库；当需要裸连接时传入 None
-    conn = _connect(database if database is not None else DB_NAME)
+    # readonly=True 时优先使用只读副本；sticky_key 标识请求方（如 ("user", uid)），
+    # 写连接提交后记录写入时间，窗口期内同一请求方的只读连接仍走主库
+    target = database if database is not None else DB_NAME
+    if readonly and DB_REPLICAS and not _recently_wrote(sticky_key):
+        conn = _connect_replica(target)
+    else:
+        conn = _connect(target)
     try:
         yield conn
         conn.commit()
+        if not readonly and sticky_key is not None:
+            _mark_write(sticky_key)
     except Exception:
-        conn.rollback()
+        # 连接已中断（如读超时）时跳过回滚/关闭，保留原始异常
+        if conn.open:
+            conn.rollback()
         raise
     finally:
-        conn.close()
+        if conn.open:
+            conn.close()
+
+
+def db_read(query, sticky_key=None):
+    """在只读连接上执行 query(cur) 并返回其结果；副本上查询失败时暂停该副本，改在主库重试一次"""
+    replica = None
+    try:
+        with db_conn(readonly=True, sticky_key=sticky_key) as conn:
+            replica = getattr(conn, "replica", None)
+            with conn.cursor() as cur:
+                return query(cur)
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+        # 复制中断、连接中途断开或读超时等视为该副本不可用；SQL 本身的错误照常抛出
+        if replica is None:
+            raise
+        _mark_replica_down(replica, e)
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            return query(cur)
 
 
 def ensure_database_and_tables():
@@ -110,6 +255,8 @@ def ensure_database_and_tables():
             movement ENUM('骑行','地铁出行','公交出行','步行','兑换'),
             `distance` DOUBLE,
             ji INT,
+            gid INT NULL,
+            sid CHAR(10) NULL,
             INDEX idx_uid_date (uid, date_time),
             FOREIGN KEY (uid) REFERENCES `user`(uid)
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
@@ -147,6 +294,35 @@ def ensure_database_and_tables():
         """
     )
 
+    ddl_idempotency_keys = (
+        """
+        CREATE TABLE IF NOT EXISTS `idempotency_keys` (
+            uid CHAR(10),
+            endpoint CHAR(20),
+            idem_key VARCHAR(64) COLLATE utf8mb4_bin,
+            request_hash CHAR(64),
+            response TEXT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (uid, endpoint, idem_key),
+            INDEX idx_created_at (created_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """
+    )
+
+    # 商户按日兑换计数，随兑换事务累加，/api/merchant/stats 直接读取
+    ddl_merchant_daily_stats = (
+        """
+        CREATE TABLE IF NOT EXISTS `merchant_daily_stats` (
+            sid CHAR(10),
+            stat_date DATE,
+            redeem_count INT NOT NULL DEFAULT 0,
+            points_total INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (sid, stat_date),
+            FOREIGN KEY (sid) REFERENCES `shop`(sid)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """
+    )
+
     with db_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(ddl_user)
@@ -154,6 +330,8 @@ def ensure_database_and_tables():
             cur.execute(ddl_points)
             cur.execute(ddl_goods)
             cur.execute(ddl_goods_requests)
+            cur.execute(ddl_idempotency_keys)
+            cur.execute(ddl_merchant_daily_stats)
 
 
 def migrate_points_table():
@@ -177,10 +355,146 @@ def migrate_points_table():
                 has_idx = cur.fetchone()
                 if not has_idx:
                     cur.execute("CREATE INDEX idx_uid_date ON `points`(uid, date_time)")
+                # 兑换记录关联商品与商户
+                cur.execute("SHOW COLUMNS FROM `points` LIKE 'gid'")
+                if not cur.fetchone():
+                    cur.execute("ALTER TABLE `points` ADD COLUMN gid INT NULL, ADD COLUMN sid CHAR(10) NULL")
     except Exception as e:
         print(f"[WARN] migrate_points_table failed: {e}")
 
 
+def purge_idempotency_keys(limit: int | None = None):
+    """清理数据库中已过期的幂等记录；limit 为空时一次清理全部"""
+    sql = "DELETE FROM `idempotency_keys` WHERE created_at < %s"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (datetime.now() - timedelta(seconds=IDEMPOTENCY_TTL),))
+    except Exception as e:
+        print(f"[WARN] purge_idempotency_keys failed: {e}")
+
+
+############################################
+# 幂等键（内存 LRU/TTL 缓存 + 数据库持久化）
+############################################
+
+
+def get_idempotency_key():
+    # 返回 (key, error)；未携带请求头时 key 为 None
+    key = (request.headers.get(IDEMPOTENCY_HEADER) or "").strip()
+    if not key:
+        return None, None
+    if len(key) > IDEMPOTENCY_KEY_MAX_LEN:
+        return None, f"{IDEMPOTENCY_HEADER} 长度不能超过{IDEMPOTENCY_KEY_MAX_LEN}"
+    return key, None
+
+
+def request_fingerprint(data) -> str:
+    # 请求体的规范化哈希，用于识别同一幂等键被用于不同请求
+    raw = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _idem_cache_get(cache_key):
+    with idem_cache_lock:
+        entry = idem_cache.get(cache_key)
+        if entry is None:
+            return None
+        stored_at, request_hash, body = entry
+        if time.time() - stored_at > IDEMPOTENCY_TTL:
+            idem_cache.pop(cache_key, None)
+            return None
+        idem_cache.move_to_end(cache_key)
+        return request_hash, body
+
+
+def _idem_cache_put(cache_key, request_hash, body, stored_at=None):
+    with idem_cache_lock:
+        idem_cache[cache_key] = (stored_at if stored_at is not None else time.time(), request_hash, body)
+        idem_cache.move_to_end(cache_key)
+        while len(idem_cache) > IDEMPOTENCY_CACHE_SIZE:
+            idem_cache.popitem(last=False)
+
+
+def load_idempotent_response(uid, endpoint, key):
+    """查找已记录的 (请求指纹, 响应)：先查本进程缓存，未命中再查数据库（其他 worker 写入的记录）"""
+    cache_key = (uid, endpoint, key)
+    cached = _idem_cache_get(cache_key)
+    if cached is not None:
+        return cached
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT request_hash, response, created_at FROM `idempotency_keys`
+                WHERE uid=%s AND endpoint=%s AND idem_key=%s AND created_at >= %s AND response IS NOT NULL
+                """,
+                (uid, endpoint, key, datetime.now() - timedelta(seconds=IDEMPOTENCY_TTL)),
+            )
+            row = cur.fetchone()
+    if not row:
+        return None
+    body = json.loads(row["response"])
+    _idem_cache_put(cache_key, row["request_hash"], body, row["created_at"].timestamp())
+    return row["request_hash"], body
+
+
+def claim_idempotency_key(cur, uid, endpoint, key, request_hash):
+    # 作为事务的第一条写入先占用幂等键：并发的同键请求会阻塞在主键上，
+    # 待先到者提交后抛出 IntegrityError，此时尚未触及任何业务表。
+    # 已过期但尚未清理的同键记录原地覆盖（不先 DELETE，避免间隙锁导致不同键的请求互相死锁）；
+    # 未过期的同键记录保持不变，影响行数为 0
+    now = datetime.now()
+    cutoff = now - timedelta(seconds=IDEMPOTENCY_TTL)
+    cur.execute(
+        """
+        INSERT INTO `idempotency_keys`(uid, endpoint, idem_key, request_hash, response, created_at)
+        VALUES (%s, %s, %s, %s, NULL, %s)
+        ON DUPLICATE KEY UPDATE
+            request_hash = IF(created_at < %s, VALUES(request_hash), request_hash),
+            response = IF(created_at < %s, NULL, response),
+            created_at = IF(created_at < %s, VALUES(created_at), created_at)
+        """,
+        (uid, endpoint, key, request_hash, now, cutoff, cutoff, cutoff),
+    )
+    if cur.rowcount == 0:
+        raise pymysql.err.IntegrityError(1062, f"Duplicate {IDEMPOTENCY_HEADER} '{key}'")
+
+
+def save_idempotent_response(cur, uid, endpoint, key, body):
+    # 与业务写入处于同一事务，在提交前写入响应
+    cur.execute(
+        "UPDATE `idempotency_keys` SET response=%s WHERE uid=%s AND endpoint=%s AND idem_key=%s",
+        (json.dumps(body, ensure_ascii=False), uid, endpoint, key),
+    )
+
+
+def remember_idempotent_response(uid, endpoint, key, request_hash, body):
+    # 事务提交后再写入缓存，避免缓存回滚掉的响应；并定期分批清理过期记录
+    global idem_saved
+    _idem_cache_put((uid, endpoint, key), request_hash, body)
+    with idem_cache_lock:
+        idem_saved += 1
+        due = idem_saved % IDEMPOTENCY_PURGE_EVERY == 0
+    if due:
+        purge_idempotency_keys(limit=IDEMPOTENCY_PURGE_BATCH)
+
+
+def replay_idempotent_response(uid, endpoint, key, request_hash):
+    """该幂等键已有记录时返回重放的响应（请求体不一致时返回 422），否则返回 None"""
+    stored = load_idempotent_response(uid, endpoint, key)
+    if stored is None:
+        return None
+    stored_hash, body = stored
+    if stored_hash != request_hash:
+        return jsonify({"error": f"{IDEMPOTENCY_HEADER} 已用于不同的请求"}), 422
+    resp = jsonify(body)
+    resp.headers["Idempotent-Replayed"] = "true"
+    return resp
+
+
 def get_token_from_auth_header():
     auth = request.headers.get("Authorization", "")
     if auth.startswith("Bearer "):
@@ -226,7 +540,7 @@ def register():
         return jsonify({"error": "手机号长度不能超过20"}), 400
     # uid 使用 username，初始积分为 0
     try:
-        with db_conn() as conn:
+        with db_conn(sticky_key=("user", username)) as conn:
             with conn.cursor() as cur:
                 # 检查是否已存在
                 cur.execute("SELECT uid FROM `user` WHERE uid=%s", (username,))
@@ -274,14 +588,15 @@ def me():
     username = require_user_token()
     if not username:
         return jsonify({"error": "未授权"}), 401
+    def query(cur):
+        cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s", (username,))
+        return cur.fetchone()
+
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s", (username,))
-                row = cur.fetchone()
-                if not row:
-                    return jsonify({"error": "用户不存在"}), 404
-                points = int(row.get("sum_ji") or 0)
+        row = db_read(query, sticky_key=("user", username))
+        if not row:
+            return jsonify({"error": "用户不存在"}), 404
+        points = int(row.get("sum_ji") or 0)
         return jsonify({"user": {"username": username, "points": points}})
     except Exception as e:
         return jsonify({"error": f"查询失败: {e}"}), 500
@@ -292,16 +607,18 @@ def list_points():
     username = require_user_token()
     if not username:
         return jsonify({"error": "未授权"}), 401
+    def query(cur):
+        cur.execute(
+            "SELECT date_time, movement, `distance`, ji FROM `points` WHERE uid=%s ORDER BY date_time DESC LIMIT 200",
+            (username,),
+        )
+        rows = cur.fetchall() or []
+        cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s", (username,))
+        total = int((cur.fetchone() or {}).get("sum_ji") or 0)
+        return rows, total
+
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT date_time, movement, `distance`, ji FROM `points` WHERE uid=%s ORDER BY date_time DESC LIMIT 200",
-                    (username,),
-                )
-                rows = cur.fetchall() or []
-                cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s", (username,))
-                total = int((cur.fetchone() or {}).get("sum_ji") or 0)
+        rows, total = db_read(query, sticky_key=("user", username))
         # 将 datetime 序列化为 ISO 字符串
         items = []
         for r in rows:
@@ -320,13 +637,17 @@ def list_points():
 
 @app.get("/api/goods")
 def list_goods():
+    # 商品列表无需登录；携带用户令牌时，兑换后的短时间内读主库以免看到旧库存
+    username = require_user_token()
+
+    def query(cur):
+        cur.execute(
+            "SELECT gid, gname, sid, `count`, `value` FROM `goods` ORDER BY gid ASC"
+        )
+        return cur.fetchall() or []
+
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT gid, gname, sid, `count`, `value` FROM `goods` ORDER BY gid ASC"
-                )
-                rows = cur.fetchall() or []
+        rows = db_read(query, sticky_key=("user", username) if username else None)
         goods = [
             {
                 "id": r.get("gid"),
@@ -402,7 +723,7 @@ def merchant_submit():
     if not name or count <= 0 or value <= 0:
         return jsonify({"error": "参数不合法"}), 400
     try:
-        with db_conn() as conn:
+        with db_conn(sticky_key=("shop", sid)) as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -426,7 +747,7 @@ def merchant_offline():
     if gid <= 0:
         return jsonify({"error": "商品ID必填"}), 400
     try:
-        with db_conn() as conn:
+        with db_conn(sticky_key=("shop", sid)) as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT gid FROM goods WHERE gid=%s AND sid=%s", (gid, sid))
                 row = cur.fetchone()
@@ -449,14 +770,15 @@ def merchant_goods():
     sid = require_shop_token()
     if not sid:
         return jsonify({"error": "未授权"}), 401
+    def query(cur):
+        cur.execute(
+            "SELECT gid, gname, count, `value` FROM goods WHERE sid=%s ORDER BY gid ASC",
+            (sid,),
+        )
+        return cur.fetchall() or []
+
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT gid, gname, count, `value` FROM goods WHERE sid=%s ORDER BY gid ASC",
-                    (sid,),
-                )
-                rows = cur.fetchall() or []
+        rows = db_read(query, sticky_key=("shop", sid))
         items = [
             {
                 "id": r.get("gid"),
@@ -471,6 +793,47 @@ def merchant_goods():
         return jsonify({"error": f"查询失败: {e}"}), 500
 
 
+@app.get("/api/merchant/stats")
+def merchant_stats():
+    sid = require_shop_token()
+    if not sid:
+        return jsonify({"error": "未授权"}), 401
+    days = request.args.get("days", 30, type=int)
+    if days <= 0 or days > 366:
+        return jsonify({"error": "参数不合法"}), 400
+    since = datetime.now().date() - timedelta(days=days - 1)
+
+    def query(cur):
+        cur.execute(
+            """
+            SELECT stat_date, redeem_count, points_total FROM merchant_daily_stats
+            WHERE sid=%s AND stat_date >= %s ORDER BY stat_date ASC
+            """,
+            (sid, since),
+        )
+        return cur.fetchall() or []
+
+    try:
+        rows = db_read(query, sticky_key=("shop", sid))
+        items = [
+            {
+                "date": r["stat_date"].isoformat(),
+                "redeemCount": int(r.get("redeem_count") or 0),
+                "points": int(r.get("points_total") or 0),
+            }
+            for r in rows
+        ]
+        return jsonify({
+            "items": items,
+            "total": {
+                "redeemCount": sum(i["redeemCount"] for i in items),
+                "points": sum(i["points"] for i in items),
+            },
+        })
+    except Exception as e:
+        return jsonify({"error": f"查询失败: {e}"}), 500
+
+
 ############################################
 # 管理员登录与商品审核
 ############################################
@@ -490,15 +853,17 @@ def admin_login():
 
 @app.get("/api/admin/goods/pending")
 def admin_list_pending():
-    if not require_admin_token():
+    admin = require_admin_token()
+    if not admin:
         return jsonify({"error": "未授权"}), 401
+    def query(cur):
+        cur.execute(
+            "SELECT id, sid, gname, count, `value`, action, target_gid FROM goods_requests WHERE status='pending' ORDER BY created_at DESC"
+        )
+        return cur.fetchall() or []
+
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT id, sid, gname, count, `value`, action, target_gid FROM goods_requests WHERE status='pending' ORDER BY created_at DESC"
-                )
-                rows = cur.fetchall() or []
+        rows = db_read(query, sticky_key=("admin", admin))
         items = [
             {
                 "id": r.get("id"),
@@ -524,14 +889,15 @@ def _next_gid(cur):
 
 @app.post("/api/admin/goods/approve")
 def admin_approve():
-    if not require_admin_token():
+    admin = require_admin_token()
+    if not admin:
         return jsonify({"error": "未授权"}), 401
     data = request.get_json(silent=True) or {}
     rid = int(data.get("id") or 0)
     if rid <= 0:
         return jsonify({"error": "参数不合法"}), 400
     try:
-        with db_conn() as conn:
+        with db_conn(sticky_key=("admin", admin)) as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT * FROM goods_requests WHERE id=%s FOR UPDATE", (rid,))
                 req = cur.fetchone()
@@ -563,14 +929,15 @@ def admin_approve():
 
 @app.post("/api/admin/goods/reject")
 def admin_reject():
-    if not require_admin_token():
+    admin = require_admin_token()
+    if not admin:
         return jsonify({"error": "未授权"}), 401
     data = request.get_json(silent=True) or {}
     rid = int(data.get("id") or 0)
     if rid <= 0:
         return jsonify({"error": "参数不合法"}), 400
     try:
-        with db_conn() as conn:
+        with db_conn(sticky_key=("admin", admin)) as conn:
             with conn.cursor() as cur:
                 cur.execute("UPDATE goods_requests SET status='rejected' WHERE id=%s AND status='pending'", (rid,))
                 if cur.rowcount == 0:
@@ -591,11 +958,22 @@ def submit_trip():
     if mode not in RATE_BY_MODE or distance <= 0:
         return jsonify({"error": "参数不合法"}), 400
 
+    idem_key, idem_error = get_idempotency_key()
+    if idem_error:
+        return jsonify({"error": idem_error}), 400
+    request_hash = request_fingerprint(data)
+
     earned = int(round(distance * RATE_BY_MODE[mode]))
     movement_cn = MODE_EN_TO_CN[mode]
     try:
-        with db_conn() as conn:
+        if idem_key:
+            replay = replay_idempotent_response(username, "trips", idem_key, request_hash)
+            if replay is not None:
+                return replay
+        with db_conn(sticky_key=("user", username)) as conn:
             with conn.cursor() as cur:
+                if idem_key:
+                    claim_idempotency_key(cur, username, "trips", idem_key, request_hash)
                 # 记录积分变动
                 cur.execute(
                     """
@@ -612,7 +990,18 @@ def submit_trip():
                 # 查询最新积分返回
                 cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s", (username,))
                 points = int((cur.fetchone() or {}).get("sum_ji") or 0)
-        return jsonify({"earned": earned, "user": {"username": username, "points": points}})
+                body = {"earned": earned, "user": {"username": username, "points": points}}
+                if idem_key:
+                    save_idempotent_response(cur, username, "trips", idem_key, body)
+        if idem_key:
+            remember_idempotent_response(username, "trips", idem_key, request_hash, body)
+        return jsonify(body)
+    except pymysql.err.IntegrityError as e:
+        # 同一幂等键的并发请求已先提交，本次在占用幂等键时即失败、未写入积分，返回先前的响应
+        replay = replay_idempotent_response(username, "trips", idem_key, request_hash) if idem_key else None
+        if replay is not None:
+            return replay
+        return jsonify({"error": f"上报失败: {e}"}), 500
     except Exception as e:
         return jsonify({"error": f"上报失败: {e}"}), 500
 
@@ -623,41 +1012,66 @@ def redeem():
     if not username:
         return jsonify({"error": "未授权"}), 401
     data = request.get_json(silent=True) or {}
+    gid = int(data.get("gid") or 0)
     product_name = (data.get("productName") or "").strip()
     required_points = int(data.get("requiredPoints") or 0)
     if required_points <= 0:
         return jsonify({"error": "参数不合法"}), 400
+    idem_key, idem_error = get_idempotency_key()
+    if idem_error:
+        return jsonify({"error": idem_error}), 400
+    request_hash = request_fingerprint(data)
 
     try:
-        with db_conn() as conn:
+        if idem_key:
+            replay = replay_idempotent_response(username, "redeem", idem_key, request_hash)
+            if replay is not None:
+                return replay
+        with db_conn(sticky_key=("user", username)) as conn:
             with conn.cursor() as cur:
-                # 当前积分
-                cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s", (username,))
+                if idem_key:
+                    claim_idempotency_key(cur, username, "redeem", idem_key, request_hash)
+                # 当前积分；加锁读取用户与商品行，避免并发兑换超扣积分或超卖库存
+                cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s FOR UPDATE", (username,))
                 row = cur.fetchone()
+                # 以下错误返回前回滚，释放已占用的幂等键，允许客户端用同一键重试
                 if not row:
+                    conn.rollback()
                     return jsonify({"error": "用户不存在"}), 404
                 current = int(row.get("sum_ji") or 0)
-                # 尝试从 goods 查找该商品
+                # 按商品ID查找；旧客户端未传 gid 时先按名称解析出 gid（不加锁），再按主键加锁读取
                 cost = required_points
                 goods_found = None
-                if product_name:
-                    cur.execute("SELECT gid, gname, `value`, `count` FROM `goods` WHERE gname=%s", (product_name,))
+                if gid <= 0 and product_name:
+                    cur.execute("SELECT gid FROM `goods` WHERE gname=%s LIMIT 1", (product_name,))
+                    gid = int((cur.fetchone() or {}).get("gid") or 0)
+                if gid > 0:
+                    cur.execute("SELECT gid, gname, sid, `value`, `count` FROM `goods` WHERE gid=%s FOR UPDATE", (gid,))
                     goods_found = cur.fetchone()
-                    if goods_found:
-                        if int(goods_found.get("count") or 0) <= 0:
-                            return jsonify({"error": "该商品库存不足"}), 400
-                        cost = int(goods_found.get("value") or required_points)
+                    if not goods_found:
+                        conn.rollback()
+                        return jsonify({"error": "商品不存在"}), 404
+                    product_name = goods_found.get("gname") or product_name
+                if goods_found:
+                    if int(goods_found.get("count") or 0) <= 0:
+                        conn.rollback()
+                        return jsonify({"error": "该商品库存不足"}), 400
+                    cost = int(goods_found.get("value") or required_points)
 
                 if current < cost:
+                    conn.rollback()
                     return jsonify({"error": f"积分不足，还需 {cost - current} 积分"}), 400
 
-                # 记录兑换为负积分
+                # 记录兑换为负积分，并关联商品与商户
+                now = datetime.now()
+                gid = goods_found["gid"] if goods_found else None
+                sid = goods_found.get("sid") if goods_found else None
                 cur.execute(
                     """
-                    INSERT INTO `points`(uid, date_time, movement, `distance`, ji)
-                    VALUES (%s, %s, '兑换', %s, %s)
+                    INSERT INTO `points`(uid, date_time, movement, `distance`, ji, gid, sid)
+                    VALUES (%s, %s, '兑换', %s, %s, %s, %s)
                     """,
-                    (username, datetime.now(), 0.0, -cost),
+                    (username, now, 0.0, -cost, gid, sid),
                 )
                 # 扣减积分
                 cur.execute(
@@ -666,16 +1080,37 @@ def redeem():
                 )
                 # 扣减库存（若商品存在）
                 if goods_found:
-                    cur.execute("UPDATE `goods` SET `count` = `count` - 1 WHERE gid=%s", (goods_found["gid"],))
+                    cur.execute("UPDATE `goods` SET `count` = `count` - 1 WHERE gid=%s", (gid,))
+                # 累加商户当日兑换计数
+                if sid:
+                    cur.execute(
+                        """
+                        INSERT INTO merchant_daily_stats(sid, stat_date, redeem_count, points_total)
+                        VALUES (%s, %s, 1, %s)
+                        ON DUPLICATE KEY UPDATE redeem_count = redeem_count + 1, points_total = points_total + VALUES(points_total)
+                        """,
+                        (sid, now.date(), cost),
+                    )
 
                 # 查询最新积分
                 cur.execute("SELECT sum_ji FROM `user` WHERE uid=%s", (username,))
                 new_points = int((cur.fetchone() or {}).get("sum_ji") or 0)
-        return jsonify({
-            "success": True,
-            "product": product_name,
-            "user": {"username": username, "points": new_points}
-        })
+                body = {
+                    "success": True,
+                    "product": product_name,
+                    "user": {"username": username, "points": new_points}
+                }
+                if idem_key:
+                    save_idempotent_response(cur, username, "redeem", idem_key, body)
+        if idem_key:
+            remember_idempotent_response(username, "redeem", idem_key, request_hash, body)
+        return jsonify(body)
+    except pymysql.err.IntegrityError as e:
+        # 同一幂等键的并发请求已先提交，本次在占用幂等键时即失败、未扣减积分，返回先前的响应
+        replay = replay_idempotent_response(username, "redeem", idem_key, request_hash) if idem_key else None
+        if replay is not None:
+            return replay
+        return jsonify({"error": f"兑换失败: {e}"}), 500
     except Exception as e:
         return jsonify({"error": f"兑换失败: {e}"}), 500
 
@@ -704,6 +1139,7 @@ if __name__ == "__main__":
     try:
         ensure_database_and_tables()
         migrate_points_table()
+        purge_idempotency_keys()
         serve_index()
     except Exception as e:
         print(f"[WARN] 初始化数据库/数据表时发生错误: {e}")
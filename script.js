@@ -12,6 +12,26 @@ function resolveApiBase() {
 const API_BASE = resolveApiBase();
 const AUTH_KEY = 'green_points_auth';
 
+// 每次用户操作生成一个幂等键；非 https 页面下 crypto.randomUUID 不可用，退回随机串
+function newIdempotencyKey() {
+	if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+		return window.crypto.randomUUID();
+	}
+	return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+// 网络异常时重试；重试沿用同一个 Idempotency-Key，后端据此返回首次结果而不重复记账
+async function fetchWithRetry(url, options, retries = 2) {
+	for (let attempt = 0; ; attempt++) {
+		try {
+			return await fetch(url, options);
+		} catch (err) {
+			if (attempt >= retries) throw err;
+			await new Promise(resolve => setTimeout(resolve, 500 * (attempt + 1)));
+		}
+	}
+}
+
 // DOM 元素
 const loginForm = document.getElementById('login-form');
 const registerForm = document.getElementById('register-form');
@@ -141,13 +161,15 @@ tripForm.addEventListener('submit', async function (e) {
 
 	const distance = parseFloat(document.getElementById('distance').value);
 	const mode = document.getElementById('mode').value;
+	const idempotencyKey = newIdempotencyKey();
 
 	try {
-		const res = await fetch(`${API_BASE}/trips`, {
+		const res = await fetchWithRetry(`${API_BASE}/trips`, {
 			method: 'POST',
 			headers: {
 				'Content-Type': 'application/json',
-				'Authorization': `Bearer ${auth.token}`
+				'Authorization': `Bearer ${auth.token}`,
+				'Idempotency-Key': idempotencyKey
 			},
 			body: JSON.stringify({ distance, mode })
 		});
@@ -178,17 +200,20 @@ goodsGrid.addEventListener('click', async (e) => {
 	}
 
 	const productEl = btn.closest('.product');
+	const gid = Number(productEl.dataset.productId);
 	const product = productEl.dataset.productName;
 	const required = Number(productEl.dataset.requiredPoints);
+	const idempotencyKey = newIdempotencyKey();
 
 	try {
-		const res = await fetch(`${API_BASE}/redeem`, {
+		const res = await fetchWithRetry(`${API_BASE}/redeem`, {
 			method: 'POST',
 			headers: {
 				'Content-Type': 'application/json',
-				'Authorization': `Bearer ${auth.token}`
+				'Authorization': `Bearer ${auth.token}`,
+				'Idempotency-Key': idempotencyKey
 			},
-			body: JSON.stringify({ productName: product, requiredPoints: required })
+			body: JSON.stringify({ gid, productName: product, requiredPoints: required })
 		});
 		const data = await res.json();
 		if (!res.ok) throw new Error(data.error || '兑换失败');
@@ -245,7 +270,10 @@ function renderPointsTable(items) {
 
 async function fetchGoods() {
 	try {
-		const res = await fetch(`${API_BASE}/goods`);
+		// 登录后携带令牌，使兑换后的商品库存立即可见
+		const auth = loadAuth();
+		const headers = auth && auth.token ? { 'Authorization': `Bearer ${auth.token}` } : {};
+		const res = await fetch(`${API_BASE}/goods`, { headers });
 		const data = await res.json();
 		if (!res.ok) throw new Error(data.error || '加载商品失败');
 		renderGoods(data.goods || []);
@@ -264,6 +292,7 @@ function renderGoods(goods) {
 	goods.forEach(item => {
 		const card = document.createElement('div');
 		card.className = 'product';
+		card.dataset.productId = item.id;
 		card.dataset.productName = item.name;
 		card.dataset.requiredPoints = item.value || 0;
 